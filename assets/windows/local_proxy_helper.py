@@ -1,9 +1,23 @@
 from argparse import ArgumentParser
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass
+import errno
+from functools import lru_cache, partial
 import logging
+import os
+import shlex
 from shutil import which
 import subprocess
+import sys
+import time
+from typing import Any
 
-import boto3
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
 
 '''
 Helper module to run and execute a local proxy on Windows machines.
@@ -11,6 +25,7 @@ This must be in the dir as localproxy.exe with dependencies, inluding the cert d
 
 Dependencies to install: 
 python -m pip install boto3
+python -m pip install aioboto3 (only needed for --devices)
 
 Exactly one client is allowed to access the device remotely.
 
@@ -30,16 +45,20 @@ options:
   -p PROFILE, --profile PROFILE
                         Specify a valid AWS profile name
   -r REGION, --region REGION
+  -d DEVICES, --devices DEVICES
+                        Connect to every <device> listed in a file, one per line, concurrently. Each device
+                        after the first gets its service ports offset by its position in the file
+
+Set TUNNEL_HELPER_DAEMON=1 to keep the helper running and read one set of the options
+above per line from stdin, reusing the same AWS session and client for every command.
 
 IoT Tunnelling API:
 https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/iotsecuretunneling.html
 '''
 
-logging.getLogger().setLevel(logging.INFO)
-
-OPEN = {'OPEN'}
-CLOSED = {'CLOSED'}
-NO_TUNNEL = {'NO TUNNEL'}
+OPEN = 'OPEN'
+CLOSED = 'CLOSED'
+NO_TUNNEL = 'NO TUNNEL'
 SOURCE_TOKEN = "source"
 DESTINATION_TOKEN = "destination"
 CLIENT_MODES = {'S':'SOURCE','D':'DESTINATION', 'A':'ALL'}
@@ -47,10 +66,22 @@ GORT = 'GORT'
 SSH = 'SSH'
 SSH_PORT = 2222
 GORT_PORT = 5555
-SERVICES = [GORT,SSH]
-
-client = None
-REGION = None
+# Single source of truth for the tunnelled services, their default local ports and the
+# short option for the port (None to only add the long --<name>-port option)
+SERVICE_PORTS = [(SSH, SSH_PORT, '-sp'), (GORT, GORT_PORT, '-gp')]
+SERVICES = [name for name, _, _ in SERVICE_PORTS]
+DEFAULT_REGION = 'eu-west-1'
+DEVICE_LOCK_FILE = '.tunnel-helper-{}.lock'
+DEVICE_LOCK_RETRY_SECONDS = 0.5
+TUNNEL_PAGE_SIZE = 50
+# Keep TCP+TLS warm between the back to back tunnelling calls of a single run
+CLIENT_CONFIG_OPTIONS = dict(
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=15,
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    max_pool_connections=10,
+)
 
 
 class TunnelStatusException(Exception):
@@ -59,190 +90,523 @@ class TunnelStatusException(Exception):
         super().__init__(self.message)
 
 
+@dataclass(frozen=True)
+class TunnelCtx:
+    '''
+        The tunnelling client and the region it talks to, passed to every tunnel operation
+    '''
+    client: Any
+    region: str
+
+
+@lru_cache(maxsize=None)
+def _get_session(profile):
+    '''
+        Build the boto3 session once per profile and reuse it. The session holds the resolved
+        (refreshable) credentials, so every region and command in this process shares them
+        params - profile
+    '''
+    # Imported here so --help and argument errors don't pay for loading boto3
+    import boto3
+    import botocore.session
+    # Only search the bundled service models, not AWS_DATA_PATH or a config file data_path
+    botocore_session = botocore.session.Session(session_vars={'data_path': (None, None, None, None)})
+    return boto3.Session(botocore_session=botocore_session, profile_name=profile)
+
+
+@lru_cache(maxsize=None)
+def _get_client(profile, region):
+    '''
+        Build the iotsecuretunneling client once per (profile, region) and reuse it
+        params - profile, region
+    '''
+    from botocore.config import Config
+    return _get_session(profile).client('iotsecuretunneling', region_name=region, config=Config(**CLIENT_CONFIG_OPTIONS))
+
+
+@lru_cache(maxsize=None)
+def _get_ctx(profile, region):
+    '''
+        Build the TunnelCtx once per (profile, region) and reuse it
+        params - profile, region
+    '''
+    return TunnelCtx(_get_client(profile, region), region)
+
+
 def start_boto3_client_session(profile, region):
     '''
         Get the boto3 client session which will be used to connect to AWS
-        params - profile
+        params - profile, region
+        returns - the TunnelCtx to pass to the tunnel operations, or None if the session failed
     '''
-    global client, REGION
     try:
-        REGION = region
-        session = boto3.Session(profile_name=profile, region_name=REGION)
-
-        client = session.client('iotsecuretunneling')
+        return _get_ctx(profile, region)
     except Exception as e:
-        logging.exception(f"Exception in starting the AWS boto3 session:{e}")
+        logging.exception("Exception in starting the AWS boto3 session:%s", e)
+        return None
+
+
+def _warm_client(profile=None, region=DEFAULT_REGION):
+    '''
+        Build the session and client ahead of the first tunnel call, e.g. from a Lambda
+        init or a long lived host importing this module, so later calls reuse them
+        params - profile, region
+        returns - the TunnelCtx to pass to the tunnel operations
+    '''
+    return start_boto3_client_session(profile, region)
+
 
+def _iter_tunnel_summaries(ctx, device_id):
+    '''
+        Yield every tunnel summary for a device, following list_tunnels pagination.
+        botocore ships no paginator for list_tunnels, so nextToken is followed by hand
+        params - ctx, device_id
+    '''
+    kwargs = {'thingName': device_id, 'maxResults': TUNNEL_PAGE_SIZE}
+    while True:
+        page = ctx.client.list_tunnels(**kwargs)
+        yield from page.get('tunnelSummaries') or []
+        next_token = page.get('nextToken')
+        if not next_token:
+            return
+        kwargs['nextToken'] = next_token
 
-def _get_open_tunnel_for_device(deviceId):
+
+def _get_open_tunnel_for_device(ctx, deviceId):
     '''
         Get the status of the tunnel. If no tunnels are assign to the device, or there
         are more than one, raise and error.
-        params - deviceId
+        params - ctx, deviceId
     '''
-    global client
-    tunnel_summaries = client.list_tunnels(thingName=deviceId).get('tunnelSummaries',[])
-    open_tunnels = [open_tunnel for open_tunnel in tunnel_summaries if open_tunnel.get('status') in OPEN]
-    closed_tunnels = [closed_tunnel for closed_tunnel in tunnel_summaries if closed_tunnel.get('status') in CLOSED]
-    
-    if len(closed_tunnels) > 0:
-        for closed_tunnel in closed_tunnels:
-            delete_tunnel(closed_tunnel.get('tunnelId'))
-    if len(open_tunnels) > 1:      
+    open_ids = []
+    closed_ids = []
+    for tunnel_summary in _iter_tunnel_summaries(ctx, deviceId):
+        tunnel_status = tunnel_summary.get('status')
+        if tunnel_status == OPEN:
+            open_ids.append(tunnel_summary.get('tunnelId'))
+        elif tunnel_status == CLOSED:
+            closed_ids.append(tunnel_summary.get('tunnelId'))
+
+    if len(closed_ids) > 0:
+        # boto3 clients are thread safe, so the shared cached client can delete in parallel
+        with ThreadPoolExecutor(max_workers=min(8, len(closed_ids))) as executor:
+            list(executor.map(partial(delete_tunnel, ctx), closed_ids))
+    if len(open_ids) > 1:      
         raise TunnelStatusException("There are more than 1 tunnel created for this device. Only one OPEN tunnel is allowed")
 
-    if len(open_tunnels) == 0:
-        status = "NO TUNNEL"
+    if len(open_ids) == 0:
+        status = NO_TUNNEL
         tunnel_id = None
 
     else:
-        open_tunnel = open_tunnels[0]
-        status = open_tunnel.get('status')
-        tunnel_id = open_tunnel.get('tunnelId')
+        status = OPEN
+        tunnel_id = open_ids[0]
 
     return status, tunnel_id
 
-def is_open(device_id):
+def is_open(ctx, device_id):
     '''
         Given a specified device ID, when the application checks for an existing open tunnel,
         determine if an open tunnel already exists for the device.
     '''
     try:
-        status,tunnel_id = _get_open_tunnel_for_device(device_id)
-        logging.info(f'Tunnel with id {tunnel_id} for {device_id} is {status}.')
+        status,tunnel_id = _get_open_tunnel_for_device(ctx, device_id)
+        logging.info('Tunnel with id %s for %s is %s.', tunnel_id, device_id, status)
     except TunnelStatusException as e:
-        logging.exception(str(e))
+        logging.exception('%s', e)
 
-def rotate_access_tokens(device_id):
+def rotate_access_tokens(ctx, device_id):
     '''
     Given an existing open tunnel for the specified device ID, when the application detects it,
     it should rotate the access tokens for both the source and destination clients before establishing a connection as the source client.
     '''
     try:
-        global client
-        status,tunnel_id = _get_open_tunnel_for_device(device_id)
+        status,tunnel_id = _get_open_tunnel_for_device(ctx, device_id)
 
-        if status not in OPEN:
-            logging.info(f'Cannot rotate tokens as tunnel with id {tunnel_id} for {device_id} is {status}. Create a new tunnel')
+        if status != OPEN:
+            logging.info('Cannot rotate tokens as tunnel with id %s for %s is %s. Create a new tunnel', tunnel_id, device_id, status)
         else:
-            destinationConfig={'thingName': device_id,'services': SERVICES}
-            tokens = client.rotate_tunnel_access_token(tunnelId=tunnel_id,clientMode=CLIENT_MODES.get('A'),destinationConfig=destinationConfig)
-            sourceAccessToken = tokens.get('sourceAccessToken')
-            destinationAccessToken = tokens.get('destinationAccessToken')
-            logging.info(f'Tokens rotated for tunnel with id {tunnel_id} for {device_id}')
-            logging.debug(f'Source Token {sourceAccessToken}')
-            logging.debug(f'Destination Token {destinationAccessToken}')
-            return sourceAccessToken, destinationAccessToken
+            return _rotate_known_tunnel(ctx, device_id, tunnel_id)
 
     except TunnelStatusException as e:
-        logging.exception(str(e))
+        logging.exception('%s', e)
         return None
 
 
-def open_tunnel(device_id):
+def _rotate_known_tunnel(ctx, device_id, tunnel_id):
+    '''
+    Rotate the access tokens of a tunnel already known to be OPEN, without listing the tunnels again.
+    '''
+    destinationConfig={'thingName': device_id,'services': SERVICES}
+    tokens = ctx.client.rotate_tunnel_access_token(tunnelId=tunnel_id,clientMode=CLIENT_MODES.get('A'),destinationConfig=destinationConfig)
+    return _access_tokens(tokens, 'Tokens rotated for tunnel with id %s for %s', tunnel_id, device_id)
+
+
+def open_tunnel(ctx, device_id):
     '''
     Given a request for a new token, when the application does not find an existing open tunnel for the specified device ID,
     it should correctly request a new tunnel to be opened.
     '''
-    global client
-    tunnel_summaries = client.list_tunnels(thingName=device_id).get('tunnelSummaries')
-
-    if len(tunnel_summaries) == 0:
-        logging.info(f"Create a new tunnel for {device_id}")
+    # Only the first page is fetched, as any existing tunnel stops a new one being opened
+    tunnel_summary = next(_iter_tunnel_summaries(ctx, device_id), None)
 
-        tokens = client.open_tunnel(
-            destinationConfig={
-                'thingName': device_id,
-                'services': SERVICES
-            })
-        tunnel_id = tokens.get('tunnelId')
-        sourceAccessToken = tokens.get('sourceAccessToken')
-        destinationAccessToken = tokens.get('destinationAccessToken')
-        logging.info(f"New tunnel created {tunnel_id} for {device_id}")
-        return sourceAccessToken, destinationAccessToken
+    if tunnel_summary is None:
+        return _open_without_listing(ctx, device_id)
 
     else:
-        status = tunnel_summaries[0].get('status')
-        tunnel_id = tunnel_summaries[0].get('tunnelId')
-        logging.info(f"Not Opening a new tunnel. There is a tunnel {tunnel_id} for {device_id} with status {status}")
+        status = tunnel_summary.get('status')
+        tunnel_id = tunnel_summary.get('tunnelId')
+        logging.info("Not Opening a new tunnel. There is a tunnel %s for %s with status %s", tunnel_id, device_id, status)
         return None, None
 
-def delete_tunnel(tunnel_id):
+
+def _open_without_listing(ctx, device_id):
+    '''
+    Open a new tunnel for a device already known to have none, without listing the tunnels again.
+    '''
+    logging.info("Create a new tunnel for %s", device_id)
+
+    tokens = ctx.client.open_tunnel(
+        destinationConfig={
+            'thingName': device_id,
+            'services': SERVICES
+        })
+    return _access_tokens(tokens, "New tunnel created %s for %s", tokens.get('tunnelId'), device_id)
+
+
+def _access_tokens(tokens, message, *args):
+    '''
+    Log an open_tunnel/rotate_tunnel_access_token response and return its source and destination tokens
+    '''
+    sourceAccessToken = tokens.get('sourceAccessToken')
+    destinationAccessToken = tokens.get('destinationAccessToken')
+    logging.info(message, *args)
+    logging.debug('Source Token %s', sourceAccessToken)
+    logging.debug('Destination Token %s', destinationAccessToken)
+    return sourceAccessToken, destinationAccessToken
+
+
+def delete_tunnel(ctx, tunnel_id):
     '''
     Delete the tunnel - this isn't exposed via command line args, but you can
     '''
-    global client
-    logging.info(f"Deleting tunnel {tunnel_id}")
-    client.close_tunnel(tunnelId=tunnel_id,delete=True)
+    logging.info("Deleting tunnel %s", tunnel_id)
+    ctx.client.close_tunnel(tunnelId=tunnel_id,delete=True)
 
 
-def start_local_proxy_for_source(device_id, ssh_port, gort_port):
+@contextmanager
+def _device_lock(device_id):
     '''
-    Run a  new local_proxy process - only one secure tunnel can be open per device.
-    If another client runs lp, it will rotate the source and destination tokens
-    and "kick off" any connected devices.
+    Hold an exclusive lock on a per device file in the working dir, so concurrent runs for
+    the same device resolve its tunnel one at a time while other devices are unaffected
     '''
-    status,tunnel_id=_get_open_tunnel_for_device(device_id)
+    with open(DEVICE_LOCK_FILE.format(device_id), 'a+') as lock_file:
+        if os.name == 'nt':
+            # LK_LOCK gives up after 10 seconds, shorter than a slow locked section, so poll instead
+            while True:
+                lock_file.seek(0)
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError as e:
+                    # Only "locked by someone else" is worth waiting for
+                    if e.errno not in (errno.EACCES, errno.EDEADLOCK):
+                        raise
+                    time.sleep(DEVICE_LOCK_RETRY_SECONDS)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@asynccontextmanager
+async def _async_device_lock(device_id):
+    '''
+    Async sibling of _device_lock, waiting for the lock in a worker thread so other devices keep running
+    '''
+    lock = _device_lock(device_id)
+    await asyncio.to_thread(lock.__enter__)
+    try:
+        yield
+    finally:
+        lock.__exit__(None, None, None)
 
-    logging.info(f"Starting a new local proxy process for {device_id}")
 
-    if status in NO_TUNNEL:
-        logging.info(f"There is NO TUNNEL for device {device_id} - created a new local proxy process")
-        source_token,_ = open_tunnel(device_id)
-    elif status in OPEN:
-        logging.info(f"Tunnel {tunnel_id} is OPEN for device {device_id}. Rotate Access Tokens")
-        source_token,_ = rotate_access_tokens(device_id)
-    else:
-        logging.info(f"Tunnel {tunnel_id} is CLOSED for device {device_id}. delete and create a new Tunnel")
-        delete_tunnel(tunnel_id)
-        source_token,_ = open_tunnel(device_id)
+def start_local_proxy_for_source(ctx, device_id, ports):
+    '''
+    Run a  new local_proxy process - only one secure tunnel can be open per device.
+    If another client runs lp, it will rotate the source and destination tokens
+    and "kick off" any connected devices. The tunnel lookup and open/rotate hold a per
+    device lock, which only stops two runs from opening duplicate tunnels - a second
+    run on an OPEN tunnel still rotates and kicks off the first. localproxy runs outside it.
+    '''
+    # Serialise runs for the same device so their lookups, deletes and opens don't interleave
+    with _device_lock(device_id):
+        status,tunnel_id=_get_open_tunnel_for_device(ctx, device_id)
+
+        logging.info("Starting a new local proxy process for %s", device_id)
+
+        if status == NO_TUNNEL:
+            logging.info("There is NO TUNNEL for device %s - created a new local proxy process", device_id)
+            source_token,_ = _open_without_listing(ctx, device_id)
+        elif status == OPEN:
+            logging.info("Tunnel %s is OPEN for device %s. Rotate Access Tokens", tunnel_id, device_id)
+            source_token,_ = _rotate_known_tunnel(ctx, device_id, tunnel_id)
+        else:
+            logging.info("Tunnel %s is CLOSED for device %s. delete and create a new Tunnel", tunnel_id, device_id)
+            delete_tunnel(ctx, tunnel_id)
+            source_token,_ = _open_without_listing(ctx, device_id)
 
-    _run_lp_process(source_token, ssh_port, gort_port)
+    _run_lp_process(ctx, source_token, ports)
 
-def _run_lp_process(source_token, ssh_port, gort_port):
+def _run_lp_process(ctx, source_token, ports):
     '''
     Run the local proxy for the GORT client
+    params - ports maps each service name in SERVICE_PORTS to its local port
     '''
-    global REGION
     # Check if we have a system version of localproxy to use
     lp = which('localproxy')
     if lp is None:
       lp = './localproxy'
-    cmd = f'{lp} -r {REGION} -s {SSH}={ssh_port},{GORT}={gort_port} -b 0.0.0.0 -c certs -t {source_token}'
-    logging.info(f'Run local proxy:{cmd}')
-    run_status = subprocess.run(cmd, shell=True)
-
-    if run_status.returncode != 0:
+    cmd = [lp, '-r', ctx.region, '-s', _service_ports_arg(ports), '-b', '0.0.0.0', '-c', 'certs', '-t', source_token]
+    # Log everything but the access token
+    logging.info('Run local proxy:%s', subprocess.list2cmdline(cmd[:-1]))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, text=True, errors='replace') as proc:
+        try:
+            # Surface the localproxy output as it is produced rather than when it exits
+            for line in proc.stdout:
+                logging.info('%s', line.rstrip())
+            returncode = proc.wait()
+        finally:
+            # Don't leave localproxy running if we were interrupted, e.g. by Ctrl-C
+            if proc.poll() is None:
+                proc.kill()
+
+    if returncode != 0:
         logging.error("Failed to execute command")
-        exit(1)
+        sys.exit(1)
+
+def _service_ports_arg(ports):
+    '''
+    Build the localproxy -s argument, e.g. SSH=2222,GORT=5555
+    '''
+    return ','.join(f'{name}={ports[name]}' for name, _, _ in SERVICE_PORTS)
+
+async def _async_iter_tunnel_summaries(ctx, device_id):
+    '''
+        Async sibling of _iter_tunnel_summaries for an aioboto3 TunnelCtx
+        params - ctx, device_id
+    '''
+    kwargs = {'thingName': device_id, 'maxResults': TUNNEL_PAGE_SIZE}
+    while True:
+        page = await ctx.client.list_tunnels(**kwargs)
+        for tunnel_summary in page.get('tunnelSummaries') or []:
+            yield tunnel_summary
+        next_token = page.get('nextToken')
+        if not next_token:
+            return
+        kwargs['nextToken'] = next_token
+
+
+async def _async_get_open_tunnel_for_device(ctx, deviceId):
+    '''
+        Async sibling of _get_open_tunnel_for_device for an aioboto3 TunnelCtx
+        params - ctx, deviceId
+    '''
+    open_ids = []
+    closed_ids = []
+    async for tunnel_summary in _async_iter_tunnel_summaries(ctx, deviceId):
+        tunnel_status = tunnel_summary.get('status')
+        if tunnel_status == OPEN:
+            open_ids.append(tunnel_summary.get('tunnelId'))
+        elif tunnel_status == CLOSED:
+            closed_ids.append(tunnel_summary.get('tunnelId'))
+
+    await asyncio.gather(*(_async_delete_tunnel(ctx, tunnel_id) for tunnel_id in closed_ids))
+    if len(open_ids) > 1:
+        raise TunnelStatusException("There are more than 1 tunnel created for this device. Only one OPEN tunnel is allowed")
+
+    if len(open_ids) == 0:
+        return NO_TUNNEL, None
+    return OPEN, open_ids[0]
+
+
+async def _async_rotate_known_tunnel(ctx, device_id, tunnel_id):
+    '''
+    Async sibling of _rotate_known_tunnel for an aioboto3 TunnelCtx
+    '''
+    destinationConfig={'thingName': device_id,'services': SERVICES}
+    tokens = await ctx.client.rotate_tunnel_access_token(tunnelId=tunnel_id,clientMode=CLIENT_MODES.get('A'),destinationConfig=destinationConfig)
+    return _access_tokens(tokens, 'Tokens rotated for tunnel with id %s for %s', tunnel_id, device_id)
+
+
+async def _async_open_without_listing(ctx, device_id):
+    '''
+    Async sibling of _open_without_listing for an aioboto3 TunnelCtx
+    '''
+    logging.info("Create a new tunnel for %s", device_id)
+
+    tokens = await ctx.client.open_tunnel(
+        destinationConfig={
+            'thingName': device_id,
+            'services': SERVICES
+        })
+    return _access_tokens(tokens, "New tunnel created %s for %s", tokens.get('tunnelId'), device_id)
+
+
+async def _async_delete_tunnel(ctx, tunnel_id):
+    '''
+    Async sibling of delete_tunnel for an aioboto3 TunnelCtx
+    '''
+    logging.info("Deleting tunnel %s", tunnel_id)
+    await ctx.client.close_tunnel(tunnelId=tunnel_id,delete=True)
+
+
+async def start_local_proxy_for_source_async(ctx, device_id, ports):
+    '''
+    Async sibling of start_local_proxy_for_source for an aioboto3 TunnelCtx.
+    Returns the localproxy exit code instead of exiting the process.
+    '''
+    # Same per device lock as the sync path, so a concurrent -con can't open a duplicate tunnel
+    async with _async_device_lock(device_id):
+        status,tunnel_id = await _async_get_open_tunnel_for_device(ctx, device_id)
+
+        logging.info("Starting a new local proxy process for %s", device_id)
+
+        if status == NO_TUNNEL:
+            logging.info("There is NO TUNNEL for device %s - created a new local proxy process", device_id)
+            source_token,_ = await _async_open_without_listing(ctx, device_id)
+        else:
+            logging.info("Tunnel %s is OPEN for device %s. Rotate Access Tokens", tunnel_id, device_id)
+            source_token,_ = await _async_rotate_known_tunnel(ctx, device_id, tunnel_id)
+
+    return await _async_run_lp_process(ctx, device_id, source_token, ports)
+
+
+async def _async_run_lp_process(ctx, device_id, source_token, ports):
+    '''
+    Async sibling of _run_lp_process, prefixing the localproxy output with the device id
+    '''
+    lp = which('localproxy')
+    if lp is None:
+      lp = './localproxy'
+    cmd = [lp, '-r', ctx.region, '-s', _service_ports_arg(ports), '-b', '0.0.0.0', '-c', 'certs', '-t', source_token]
+    # Log everything but the access token
+    logging.info('Run local proxy for %s:%s', device_id, subprocess.list2cmdline(cmd[:-1]))
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    try:
+        async for line in proc.stdout:
+            logging.info('%s: %s', device_id, line.decode(errors='replace').rstrip())
+        returncode = await proc.wait()
+    finally:
+        # Don't leave localproxy running if this device's task was cancelled
+        if proc.returncode is None:
+            proc.kill()
+
+    if returncode != 0:
+        logging.error("Failed to execute command for %s", device_id)
+    return returncode
+
+
+async def connect_devices(profile, region, device_ids, ports):
+    '''
+    Connect to several devices concurrently over one aioboto3 client. Each device after the
+    first gets its service ports offset by its position, so the local proxies don't clash.
+    params - ports maps each service name in SERVICE_PORTS to the first device's local port
+    '''
+    # Imported here so the single device paths don't need aioboto3 installed
+    import aioboto3
+    from botocore.config import Config
+
+    session = aioboto3.Session(profile_name=profile)
+    async with session.client('iotsecuretunneling', region_name=region, config=Config(**CLIENT_CONFIG_OPTIONS)) as client:
+        ctx = TunnelCtx(client, region)
+        results = await asyncio.gather(
+            *(start_local_proxy_for_source_async(ctx, device_id, {name: port + offset for name, port in ports.items()})
+              for offset, device_id in enumerate(device_ids)),
+            return_exceptions=True,
+        )
+    for device_id, result in zip(device_ids, results):
+        if isinstance(result, Exception):
+            logging.error("Failed to connect to %s: %s", device_id, result)
+    return results
+
+def _read_device_ids(path):
+    '''
+    Read one device id per line, skipping blank lines, # comments and repeats, as two
+    connections to one device would rotate each other's tokens away
+    '''
+    with open(path) as f:
+        return list(dict.fromkeys(line.strip().upper() for line in f if line.strip() and not line.lstrip().startswith('#')))
 
 def main(args):
     
-    start_boto3_client_session(args.profile, args.region.lower())
+    ports = {name: getattr(args, f'{name.lower()}_port') for name, _, _ in SERVICE_PORTS}
+    if args.devices is not None:
+        results = asyncio.run(connect_devices(args.profile, args.region, _read_device_ids(args.devices), ports))
+        if any(isinstance(result, BaseException) or result != 0 for result in results):
+            sys.exit(1)
+        return results
+
+    ctx = start_boto3_client_session(args.profile, args.region)
     if args.create_device_tunnel is not None:
-        return open_tunnel(args.create_device_tunnel.upper())
+        return open_tunnel(ctx, args.create_device_tunnel)
     if args.get_device_tunnel_status is not None:
-        return is_open(args.get_device_tunnel_status.upper())
+        return is_open(ctx, args.get_device_tunnel_status)
     if args.rotate_device_tokens is not None:
-        return rotate_access_tokens(args.rotate_device_tokens.upper())
+        return rotate_access_tokens(ctx, args.rotate_device_tokens)
     if args.connect_device is not None:
-        return start_local_proxy_for_source(args.connect_device.upper(), args.ssh_port, args.gort_port)
+        return start_local_proxy_for_source(ctx, args.connect_device, ports)
 
     parser.print_help()
 
+def _serve_commands(parser, stream):
+    '''
+    Run one CLI command per input line in this process, so the cached session and
+    client are reused across commands instead of being rebuilt for every invocation
+    '''
+    # A failing command must not end the daemon; KeyboardInterrupt still quits it
+    for line in stream:
+        try:
+            argv = shlex.split(line)
+            if not argv:
+                continue
+            main(parser.parse_args(argv))
+        except SystemExit:
+            # argparse errors and failed localproxy runs
+            continue
+        except Exception as e:
+            logging.exception("Command failed: %s", e)
+
 if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    # botocore's INFO records (e.g. where credentials were found) are noise for this CLI
+    logging.getLogger('botocore').setLevel(logging.WARNING)
+
     parser = ArgumentParser(
         description="IoT Secure Tunnel Cli.",
     )
-    parser.add_argument('-c','--create-device-tunnel',type=str,help='Create a new tunnel for a <device>. Returned is both a source and a destination token', dest='create_device_tunnel' )
-    parser.add_argument('-g','--get-device-tunnel-status',type=str,help='Get tunnel status for a <device> - either Open, Closed, or No tunnel' , dest='get_device_tunnel_status' )
-    parser.add_argument('-ro','--rotate-device-tokens',type=str,help='Rotate tokens for <device> returned a source and a destination token', dest='rotate_device_tokens' )
-    parser.add_argument('-con', '--connect-device',type=str,help='Connect to a <device>. This starts the localproxy component service and creates or reconnects to an existing tunnnel', dest='connect_device' )
+    command = parser.add_mutually_exclusive_group()
+    command.add_argument('-c','--create-device-tunnel',type=str.upper,help='Create a new tunnel for a <device>. Returned is both a source and a destination token', dest='create_device_tunnel' )
+    command.add_argument('-g','--get-device-tunnel-status',type=str.upper,help='Get tunnel status for a <device> - either Open, Closed, or No tunnel' , dest='get_device_tunnel_status' )
+    command.add_argument('-ro','--rotate-device-tokens',type=str.upper,help='Rotate tokens for <device> returned a source and a destination token', dest='rotate_device_tokens' )
+    command.add_argument('-con', '--connect-device',type=str.upper,help='Connect to a <device>. This starts the localproxy component service and creates or reconnects to an existing tunnnel', dest='connect_device' )
+    command.add_argument('-d','--devices',type=str,help='Connect to every <device> listed in a file, one per line, concurrently', dest='devices' )
     parser.add_argument('-p','--profile',dest='profile',required=False,default=None,type=str,help='Specify a valid AWS profile name')
-    parser.add_argument('-r','--region',dest='region',default='eu-west-1',type=str,help='Specify a valid AWS region')
-    parser.add_argument('-sp','--ssh-port',dest='ssh_port',default=SSH_PORT,type=str,help='Specify a valid ssh-port')
-    parser.add_argument('-gp','--gort-port',dest='gort_port',default=GORT_PORT,type=str,help='Specify a valid gort-port')
+    parser.add_argument('-r','--region',dest='region',default=DEFAULT_REGION,type=str.lower,help='Specify a valid AWS region')
+    for name, default_port, short_option in SERVICE_PORTS:
+        option_strings = [short_option] if short_option else []
+        parser.add_argument(*option_strings,f'--{name.lower()}-port',dest=f'{name.lower()}_port',default=default_port,type=int,help=f'Specify a valid {name.lower()}-port')
 
-    args = parser.parse_args()
+    if os.environ.get('TUNNEL_HELPER_DAEMON') == '1':
+        _serve_commands(parser, sys.stdin)
+    else:
+        args = parser.parse_args()
 
-    main(args)
+        main(args)